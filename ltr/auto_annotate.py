@@ -6,9 +6,14 @@ from tqdm import tqdm
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 
 NUM_RESULTS_PER_QUERY = 100
 NUM_ENSEMBLE_PREDS = 1
+# keep the static instructions before the placeholders. llama_cpp reuses the
+# evaluated tokens of the longest common prefix with the previous prompt, so
+# the header is only prefilled once.
 PROMPT = """<|im_start|>system
 Perform the task to the best of your ability.<|im_end|>
 <|im_start|>user
@@ -20,6 +25,8 @@ Title: "{}"
 Snippet: "{}"<|im_end|>
 <|im_start|>assistant
 """
+RELEVANCY_RE = re.compile(r"Relevancy: (\d)")
+
 llm = Llama(
     n_gpu_layers=-1,
     n_ctx=8000,
@@ -28,7 +35,8 @@ llm = Llama(
 
 
 with open("data/queries_us.csv") as f:
-    all_queries = [line.strip() for line in f.readlines()]
+    # dict.fromkeys drops repeated queries while keeping file order
+    all_queries = list(dict.fromkeys(line.strip() for line in f))
 
 # shuffle queries
 np.random.shuffle(all_queries)
@@ -37,6 +45,12 @@ np.random.shuffle(all_queries)
 def setup_db():
     db = sqlite3.connect("data/auto-ranking-annotation.sqlite")
 
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA mmap_size=268435456")
+    db.execute("PRAGMA cache_size=-65536")
+
     cur = db.cursor()
 
     cur.execute(
@@ -59,39 +73,54 @@ def setup_db():
         );"""
     )
 
+    # partial indexes so the (un)annotated lookups per qid are index seeks
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_sr_qid_annot
+        ON search_results (qid) WHERE annotation IS NOT NULL;"""
+    )
+
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_sr_qid_null
+        ON search_results (qid, orig_rank) WHERE annotation IS NULL;"""
+    )
+
     db.commit()
 
     return db
 
 
-db = setup_db()
-
-cur = db.cursor()
-for query in all_queries:
+def is_valid_query(query):
     if len(query) < 3:
-        continue
+        return False
 
     # check if query has large percentage of non-alphanumeric characters
-    if sum([c.isalnum() for c in query]) / len(query) < 0.5:
-        continue
+    if sum(map(str.isalnum, query)) / len(query) < 0.5:
+        return False
 
     # only consider queries with at least two words
     if len(query.split()) < 2:
-        continue
+        return False
 
     if len(query) > 100:
-        continue
+        return False
 
-    cur.execute(
+    return True
+
+
+db = setup_db()
+
+cur = db.cursor()
+with db:
+    cur.executemany(
         """
         INSERT OR IGNORE INTO queries (query)
         VALUES (?)
         """,
-        (query,),
+        [(query,) for query in all_queries if is_valid_query(query)],
     )
 
-db.commit()
-
 unannotated_queries = cur.execute(
     """
     SELECT qid, query
@@ -107,10 +136,19 @@ unannotated_queries = {qid: query for qid, query in unannotated_queries}
 
 
 def simplify_snippet(snippet):
-    if "text" not in snippet:
+    fragments = snippet.get("text", {}).get("fragments")
+    if not fragments:
         return ""
 
-    return "".join([f["text"] for f in snippet["text"]["fragments"]])
+    if len(fragments) == 1:
+        return fragments[0]["text"]
+
+    return "".join([f["text"] for f in fragments])
+
+
+# reuse the connection to the search api across queries
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 
 def get_search_results(query):
@@ -129,34 +167,45 @@ def get_search_results(query):
             "rankingSignals": {s: v["value"] for (s, v) in w["rankingSignals"].items()},
             "snippet": simplify_snippet(w["snippet"]),
         }
-        for w in requests.post(url, json=payload).json()["webpages"][
+        for w in session.post(url, json=payload, timeout=30).json()["webpages"][
             :NUM_RESULTS_PER_QUERY
         ]
     ]
 
 
-def add_results(query):
-    has_results = (
+def has_results(qid):
+    return (
         cur.execute("SELECT 1 FROM search_results WHERE qid = ?", (qid,)).fetchone()
         is not None
     )
-    if has_results:
-        return
 
+
+def fetch_results(query):
     results = get_search_results(query)
     time.sleep(1)
+    return results
+
+
+def prefetch_results(executor, qid, query):
+    if has_results(qid):
+        return None
+
+    return executor.submit(fetch_results, query)
+
 
-    for i, result in enumerate(results):
-        cur.execute(
+def add_results(qid, results):
+    with db:
+        cur.executemany(
             """
             INSERT OR IGNORE INTO search_results (qid, url, orig_rank, webpage_json)
             VALUES (?, ?, ?, ?)
             """,
-            (qid, result["url"], i, json.dumps(result)),
+            [
+                (qid, result["url"], i, json.dumps(result))
+                for i, result in enumerate(results)
+            ],
         )
 
-    db.commit()
-
 
 def get_prompt(query, url, title, snippet):
     return PROMPT.format(
@@ -168,64 +217,84 @@ def get_prompt(query, url, title, snippet):
 
 
 def get_relevancy(res):
-    regex = r"Relevancy: (\d)"
-    matches = re.findall(regex, res)
-    if len(matches) == 0:
+    match = RELEVANCY_RE.search(res)
+    if match is None:
         return None
-    return int(matches[0])
+    return int(match.group(1))
 
 
-for qid, query in tqdm(unannotated_queries.items()):
-    add_results(query)
-    unnanotated_results = cur.execute(
-        """
-        SELECT url, orig_rank, webpage_json
-        FROM search_results
-        WHERE qid = ? AND annotation IS NULL
-        ORDER BY orig_rank
-        """,
-        (qid,),
-    ).fetchall()
-
-    for url, orig_rank, webpage_json in tqdm(unnanotated_results):
-        webpage = json.loads(webpage_json)
-        prompt = get_prompt(query, url, webpage["title"], webpage["snippet"])
-        res = 0
-        n = 0
-        for _ in range(NUM_ENSEMBLE_PREDS):
-            output = llm.create_completion(
-                prompt,
-                max_tokens=1024,
-                echo=False,
-                temperature=0.4,
-                stop=["<|im_start|>", "<|im_end|>"],
-            )
-            output = output["choices"][0]["text"]
-
-            relevancy = get_relevancy(output)
-            if relevancy is None:
-                continue
+# fetch the search results for the next query in the background
+# while the current query is being annotated by the llm
+executor = ThreadPoolExecutor(max_workers=1)
+queries = list(unannotated_queries.items())
+try:
+    next_results = prefetch_results(executor, *queries[0]) if queries else None
 
-            n += 1
-            res += relevancy
+    for i, (qid, query) in enumerate(tqdm(queries)):
+        results = next_results
+        if i + 1 < len(queries):
+            next_results = prefetch_results(executor, *queries[i + 1])
 
-        if n == 0:
-            print("No relevancy annotation for", query, url)
-            print(output)
-            continue
+        if results is not None:
+            add_results(qid, results.result())
 
-        relevancy = np.round(res / n).astype(int)
-        relevancy = max(0, min(10, int(relevancy)))
-
-        print(f'relevancy={relevancy} query="{query}" url={url}')
-
-        cur.execute(
+        unnanotated_results = cur.execute(
             """
-            UPDATE search_results
-            SET annotation = ?
-            WHERE qid = ? AND url = ?
+            SELECT
+                url,
+                json_extract(webpage_json, '$.title'),
+                json_extract(webpage_json, '$.snippet')
+            FROM search_results
+            WHERE qid = ? AND annotation IS NULL
+            ORDER BY orig_rank
             """,
-            (relevancy, qid, url),
-        )
+            (qid,),
+        ).fetchall()
+
+        annotations = []
+        for url, title, snippet in tqdm(unnanotated_results):
+            prompt = get_prompt(query, url, title, snippet)
+            res = 0
+            n = 0
+            for _ in range(NUM_ENSEMBLE_PREDS):
+                output = llm.create_completion(
+                    prompt,
+                    max_tokens=1024,
+                    echo=False,
+                    temperature=0.4,
+                    stop=["<|im_start|>", "<|im_end|>"],
+                )
+                output = output["choices"][0]["text"]
+
+                relevancy = get_relevancy(output)
+                if relevancy is None:
+                    continue
+
+                n += 1
+                res += relevancy
+
+            if n == 0:
+                print("No relevancy annotation for", query, url)
+                print(output)
+                continue
 
-        db.commit()
+            relevancy = np.round(res / n).astype(int)
+            relevancy = max(0, min(10, int(relevancy)))
+
+            print(f'relevancy={relevancy} query="{query}" url={url}')
+            annotations.append((relevancy, url))
+
+        # write all annotations for the query in a single transaction
+        with db:
+            cur.executemany(
+                """
+                UPDATE search_results
+                SET annotation = ?
+                WHERE qid = ? AND url = ?
+                """,
+                [(relevancy, qid, url) for relevancy, url in annotations],
+            )
+finally:
+    # drop a queued prefetch if the loop stopped early
+    executor.shutdown(cancel_futures=True)
+    db.close()
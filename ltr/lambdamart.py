@@ -11,36 +11,25 @@ cur = con.cursor()
 
 res = cur.execute(
     """
-        SELECT qid, query
-		FROM queries
-        WHERE EXISTS (
-			SELECT 1 FROM search_results WHERE search_results.qid = queries.qid AND search_results.annotation IS NOT NULL
-		)
+        SELECT
+            q.qid,
+            q.query,
+            s.url,
+            s.annotation,
+            json_extract(s.webpage_json, '$.rankingSignals')
+        FROM queries q
+        JOIN search_results s ON s.qid = q.qid
+        WHERE s.annotation IS NOT NULL
+        ORDER BY q.qid, s.annotation DESC
 """
 )
-queries = {qid: {"query": query} for qid, query in res.fetchall()}
-
-for qid in queries:
-    res = cur.execute(
-        """
-            SELECT qid, url, annotation, webpage_json
-            FROM search_results
-            WHERE qid = ?
-    """,
-        (qid,),
-    )
-    urls = {
-        url: {"label": label, "signals": json.loads(page)["rankingSignals"]}
-        for _, url, label, page in res.fetchall()
-    }
-    urls = [
-        (url, w["label"], w["signals"])
-        for url, w in urls.items()
-        if w["label"] is not None
-    ]
 
-    urls = sorted(urls, key=lambda x: int(x[1]), reverse=True)
-    queries[qid]["urls"] = urls
+queries = {}
+for qid, query, url, label, signals in res:
+    if qid not in queries:
+        queries[qid] = {"query": query, "urls": []}
+
+    queries[qid]["urls"].append((url, label, json.loads(signals)))
 
 
 feature2id = {}
@@ -54,90 +43,90 @@ for qid, data in queries.items():
                 feature2id[feature] = id
                 id2feature[id] = feature
 
-# convert to qid -> {url: {score, features}
-new_queries = {}
-
-for qid, data in queries.items():
-    new_queries[qid] = {}
-    for url, score, signals in data["urls"]:
-        new_queries[qid][url] = {
-            "score": score,
-            "features": {feature2id[k]: v for k, v in signals.items()},
-        }
-
-queries = new_queries
+feature_names = [id2feature[i] for i in range(len(id2feature))]
 
 # Create dataset
 items = list(queries.items())
 # shuffle items
 np.random.shuffle(items)
 
+
+def build_dataset(items):
+    num_rows = sum(len(data["urls"]) for _, data in items)
+    X = np.zeros((num_rows, len(feature2id)), dtype=np.float32)
+    y = np.empty(num_rows, dtype=np.int64)
+    qids = []
+
+    row = 0
+    for qid, data in items:
+        qids.append(qid)
+        for url, score, signals in data["urls"]:
+            for k, v in signals.items():
+                X[row, feature2id[k]] = v
+            y[row] = score
+            row += 1
+
+    return X, y, qids
+
+
 train_size = int(len(items) * 0.8)
-X_train = []
-y_train = []
-q_train = []
-for query, urls in items[:train_size]:
-    q_train.append(query)
-    for url, data in urls.items():
-        x = [data["features"].get(k, 0) for k in id2feature]
-        X_train.append(x)
-        y_train.append(data["score"])
-
-X_test = []
-y_test = []
-q_test = []
-for query, urls in items[train_size:]:
-    q_test.append(query)
-    for url, data in urls.items():
-        X_test.append([data["features"].get(k, 0) for k in id2feature])
-        y_test.append(data["score"])
-
-X_train = np.array(X_train)
-y_train = np.array(y_train)
-
-X_test = np.array(X_test)
-y_test = np.array(y_test)
+X_train, y_train, q_train = build_dataset(items[:train_size])
+X_test, y_test, q_test = build_dataset(items[train_size:])
 
 # Create group
-q_train = np.array([len(queries[qid]) for qid in q_train])
-q_test = np.array([len(queries[qid]) for qid in q_test])
+q_train = np.array([len(queries[qid]["urls"]) for qid in q_train])
+q_test = np.array([len(queries[qid]["urls"]) for qid in q_test])
 
 print("Train size:", len(X_train))
 print("Test size:", len(X_test))
 
 # Train model
 n_estimators = 50
-model = lgb.LGBMRanker(
-    objective="lambdarank",
-    metric="ndcg",
-    importance_type="gain",
-    num_leaves=50,
-    n_estimators=n_estimators,
-    categorical_features=[feature2id[k] for k in CATEGORICAL_FEATURES],
-    max_depth=10,
-    learning_rate=0.1,
-    label_gain=[i for i in range(max(y_train.max(), y_test.max()) + 1)],
-)
-model.fit(
+params = {
+    "objective": "lambdarank",
+    "metric": "ndcg",
+    "num_leaves": 50,
+    "max_depth": 10,
+    "learning_rate": 0.1,
+    "label_gain": [i for i in range(max(y_train.max(), y_test.max()) + 1)],
+    "eval_at": [1, 2, 3, 5, 10],
+}
+train_set = lgb.Dataset(
     X_train,
     y_train,
     group=q_train,
-    feature_name=[k for k in feature2id],
-    eval_set=[(X_test, y_test)],
-    eval_group=[q_test],
-    eval_at=[1, 2, 3, 5, 10],
-    eval_metric="ndcg",
+    feature_name=feature_names,
+    categorical_feature=[feature2id[k] for k in CATEGORICAL_FEATURES],
+    free_raw_data=True,
+)
+test_set = lgb.Dataset(
+    X_test,
+    y_test,
+    group=q_test,
+    reference=train_set,
+    free_raw_data=True,
+)
+model = lgb.train(
+    params,
+    train_set,
+    num_boost_round=n_estimators,
+    valid_sets=[test_set],
+    callbacks=[lgb.log_evaluation()],
 )
 
 # dump model
-model.booster_.save_model(
+model.save_model(
     "data/lambdamart.txt",
 )
 
 # print feature importance
 pprint(
     sorted(
-        [(id2feature[i], v) for i, v in enumerate(model.feature_importances_) if v > 0],
+        [
+            (id2feature[i], v)
+            for i, v in enumerate(model.feature_importance(importance_type="gain"))
+            if v > 0
+        ],
         key=lambda x: x[1],
         reverse=True,
     )
@@ -147,8 +136,7 @@ pprint(
 # for the same input
 saved_model = lgb.Booster(model_file="data/lambdamart.txt")
 
-for i in range(len(X_test)):
-    assert model.predict(X_test[i : i + 1]) == saved_model.predict(X_test[i : i + 1])
+assert np.array_equal(model.predict(X_test), saved_model.predict(X_test))
 
 # print an example
 # print("Example:")
@@ -1,7 +1,6 @@
 import sklearn
 import numpy as np
 import json
-import random
 from sklearn.linear_model import LinearRegression
 from pprint import pprint
 
@@ -14,92 +13,61 @@ cur = con.cursor()
 
 res = cur.execute(
     """
-        SELECT qid, query
-		FROM queries
-        WHERE EXISTS (
-			SELECT 1 FROM search_results WHERE search_results.qid = queries.qid AND search_results.annotation IS NOT NULL
-		)
+        SELECT
+            q.qid,
+            q.query,
+            s.url,
+            s.annotation,
+            s.orig_rank,
+            json_extract(s.webpage_json, '$.rankingSignals')
+        FROM queries q
+        JOIN search_results s ON s.qid = q.qid
+        WHERE s.annotation IS NOT NULL
+        ORDER BY q.qid, s.annotation DESC, s.orig_rank
 """
 )
-queries = {qid: {"query": query} for qid, query in res.fetchall()}
-
-for qid in queries:
-    res = cur.execute(
-        """
-            SELECT qid, url, annotation, orig_rank, webpage_json
-            FROM search_results
-            WHERE qid = ?
-    """,
-        (qid,),
-    )
-    urls = {
-        url: {
-            "label": label,
-            "orig_rank": orig_rank,
-            "signals": json.loads(page)["rankingSignals"],
-        }
-        for _, url, label, orig_rank, page in res.fetchall()
-    }
-    urls = [
-        (url, w["label"], w["orig_rank"], w["signals"])
-        for url, w in urls.items()
-        if w["label"] is not None
-    ]
-
-    sorting_key = lambda x: (
-        -x[1],
-        x[2],
-    )
-
-    urls = sorted(urls, key=sorting_key)
-    queries[qid]["urls"] = urls
-
-
-feature2id = {}
-id2feature = {}
 
-for qid, data in queries.items():
-    for url, score, _, signals in data["urls"]:
-        for feature, value in signals.items():
-            if feature not in feature2id:
-                id = len(feature2id)
-                feature2id[feature] = id
-                id2feature[id] = feature
+queries = {}
+for qid, query, url, label, orig_rank, signals in res:
+    if qid not in queries:
+        queries[qid] = {"query": query, "urls": []}
 
-# convert to [{ranking_signals, score}]
-scores = []
+    queries[qid]["urls"].append((url, label, orig_rank, json.loads(signals)))
 
-random.shuffle(scores)
 
-sorted_features = sorted(feature2id.items(), key=lambda x: x[1])
+_, _, _, first_signals = next(iter(queries.values()))["urls"][0]
+feature2id = {feature: id for id, feature in enumerate(first_signals)}
+id2feature = {id: feature for feature, id in feature2id.items()}
 
+# the model needs a value for every feature in every row
 for qid, data in queries.items():
-    for i, (url, score, _, signals) in enumerate(data["urls"]):
-        signals = {feature2id[k]: v for k, v in signals.items()}
-
-        signals = [signals[k] for _, k in sorted_features]
-
-        scores.append({"ranking_signals": signals, "score": 20 / (i + 1)})
-
-train = scores[: int(len(scores) * TRAIN_PERCENT)]
-test = scores[int(len(scores) * TRAIN_PERCENT) :]
+    for url, _, _, signals in data["urls"]:
+        if signals.keys() != feature2id.keys():
+            raise ValueError(
+                f"ranking signals of {url} (qid {qid}) differ from the first result"
+            )
+
+# convert to feature matrix and target scores
+num_rows = sum(len(data["urls"]) for data in queries.values())
+X = np.zeros((num_rows, len(feature2id)))
+y = np.empty(num_rows)
+
+row = 0
+for qid, data in queries.items():
+    urls = data["urls"]
+    y[row : row + len(urls)] = 20 / np.arange(1, len(urls) + 1)
 
-X_train = []
-y_train = []
-for score in train:
-    X_train.append(score["ranking_signals"])
-    y_train.append(score["score"])
+    for url, score, _, signals in urls:
+        for k, v in signals.items():
+            X[row, feature2id[k]] = v
+        row += 1
 
-X_test = []
-y_test = []
-for score in test:
-    X_test.append(score["ranking_signals"])
-    y_test.append(score["score"])
+train_size = int(num_rows * TRAIN_PERCENT)
 
-X_train = np.array(X_train)
-y_train = np.array(y_train)
-X_test = np.array(X_test)
-y_test = np.array(y_test)
+X_train = X[:train_size]
+y_train = y[:train_size]
+X_test = X[train_size:]
+y_test = y[train_size:]
 
 model = LinearRegression(fit_intercept=False, positive=True)
 # model = SVR(kernel="linear")
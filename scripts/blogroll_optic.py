@@ -329,14 +329,17 @@ hackernews_blogs = [
 
 blogs = set(blogroll_org + hackernews_blogs)
 
-optic = "DiscardNonMatching;\n"
-for blog in blogs:
-    optic += f"""Rule {{
+rules = [
+    f"""Rule {{
         Matches {{
             Site("|{blog}|")
         }},
         Action(Boost(0))
 }};
 """
+    for blog in blogs
+]
+
+optic = "DiscardNonMatching;\n" + "".join(rules)
 
 print(optic)
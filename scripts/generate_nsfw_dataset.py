@@ -5065,9 +5065,12 @@ Like(Site("redtube.com"));
 """
 
 
+session = requests.Session()
+
+
 def search(json):
     json["numResults"] = 50
-    r = requests.post(
+    r = session.post(
         "https://stract.com/beta/api/search",
         json=json,
     ).json()
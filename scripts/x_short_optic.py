@@ -16,8 +16,11 @@ with open(args.million_short_file, 'r') as f:
         domain = line.strip().split(',')[1]
         domains.append(domain)
 
-optic = "// Generated from the following list: https://tranco-list.eu/ \n"
-for domain in domains:
-    optic += f"""Rule {{ Matches {{ Domain("|{domain}|") }}, Action(Discard) }};"""
+rules = [
+    f"""Rule {{ Matches {{ Domain("|{domain}|") }}, Action(Discard) }};"""
+    for domain in domains
+]
+
+optic = "// Generated from the following list: https://tranco-list.eu/ \n" + "".join(rules)
 
 print(optic)